@@ -0,0 +1,203 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web, ClientSession
+from config import LLM_RATE_LIMIT
+
+TENANT_COUNTS = [1, 10, 50]
+CHATS_PER_TENANT = 2
+MESSAGES_PER_CHAT = 10
+LLM_LATENCY = 0.05  # Seconds the stub LLM takes per request
+TIMEOUT = 60  # Seconds to wait for replies on top of the time the rate limit needs
+USER_ID = 1000
+
+# Stub Telegram Bot API and LLM API, run in their own process so they do not count towards the bot's RSS
+class Stubs:
+    def __init__(self):
+        # Pending updates for each bot token
+        self.updates = {}
+        # Messages sent by each run
+        self.sent = {}
+        self.next_message_id = 1
+
+    def queue_updates(self, token):
+        updates = []
+        update_id = 1
+        for chat in range(CHATS_PER_TENANT):
+            for i in range(MESSAGES_PER_CHAT):
+                updates.append({
+                    "update_id": update_id,
+                    "message": {
+                        "message_id": update_id,
+                        "date": int(time.time()),
+                        "chat": {"id": USER_ID + chat, "type": "private"},
+                        "from": {"id": USER_ID + chat, "is_bot": False, "first_name": "User"},
+                        "text": f"Hello {i}"
+                    }
+                })
+                update_id += 1
+        self.updates[token] = updates
+
+    async def telegram(self, request):
+        token = request.match_info['token']
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if method == 'getMe':
+            result = {"id": abs(hash(token)) % 10 ** 9, "is_bot": True, "first_name": "Stub", "username": "stub_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        elif method == 'getUpdates':
+            if token not in self.updates:
+                self.queue_updates(token)
+            offset = int(params.get('offset') or 0)
+            result = [update for update in self.updates[token] if update['update_id'] >= offset]
+            self.updates[token] = result
+            if not result:
+                await asyncio.sleep(min(float(params.get('timeout') or 0), 1))
+        elif method == 'sendMessage':
+            run_id = token.split('-', 1)[0]
+            self.sent[run_id] = self.sent.get(run_id, 0) + 1
+            self.next_message_id += 1
+            result = {"message_id": self.next_message_id, "date": int(time.time()),
+                      "chat": {"id": int(params['chat_id']), "type": "private"}, "text": params.get('text', '')}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def llm(self, request):
+        await request.json()
+        await asyncio.sleep(LLM_LATENCY)
+        return web.json_response({
+            "choices": [{"message": {"role": "assistant", "content": "Hi there!"}}],
+            "usage": {"prompt_tokens": 50, "completion_tokens": 5, "total_tokens": 55}
+        })
+
+    async def stats(self, request):
+        return web.json_response({"sent": self.sent.get(request.query['run'], 0)})
+
+def serve_stubs(port):
+    stubs = Stubs()
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', stubs.telegram)
+    app.router.add_post('/v1/chat/completions', stubs.llm)
+    app.router.add_get('/stats', stubs.stats)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+def read_rss_kb(field):
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+# Host tenant_count bots in this process against the stubs and report RSS and throughput
+async def host(tenant_count, port, run_id, rate_limit):
+    import llm_pool
+    from bot import run_tenants
+    from tenants import Tenant
+
+    llm_pool._rate_limiter = llm_pool.RateLimiter(rate_limit)
+    stub_personalities = {
+        "DefaultPersonality": {
+            "api_url": f"http://127.0.0.1:{port}/v1/chat/completions",
+            "prompt": "You are chatgpt.",
+            "temperature": 0.6,
+            "model": "stub"
+        }
+    }
+    tenants = [
+        Tenant(f"bot{i + 1}", f"{run_id}-{i}:stub", [USER_ID + chat for chat in range(CHATS_PER_TENANT)],
+               personalities=stub_personalities, base_url=f"http://127.0.0.1:{port}/bot")
+        for i in range(tenant_count)
+    ]
+    expected = tenant_count * CHATS_PER_TENANT * MESSAGES_PER_CHAT
+
+    rss_before = read_rss_kb('VmRSS:')
+    stop_event = asyncio.Event()
+    start = time.perf_counter()
+    runner = asyncio.create_task(run_tenants(tenants, stop_event))
+
+    # A tenant that fails to start is skipped by run_tenants, so also give up after a deadline
+    deadline = time.monotonic() + TIMEOUT + (expected / rate_limit if rate_limit else 0)
+    async with ClientSession() as session:
+        sent = 0
+        while sent < expected:
+            await asyncio.sleep(0.05)
+            if runner.done():
+                runner.result()
+                raise RuntimeError(f"Bots stopped after {sent} of {expected} replies")
+            if time.monotonic() > deadline:
+                stop_event.set()
+                await runner
+                raise RuntimeError(f"Timed out after {sent} of {expected} replies")
+            async with session.get(f"http://127.0.0.1:{port}/stats", params={"run": run_id}) as response:
+                sent = (await response.json())['sent']
+    elapsed = time.perf_counter() - start
+    rss_after = read_rss_kb('VmRSS:')
+    rss_peak = read_rss_kb('VmHWM:')
+
+    stop_event.set()
+    await runner
+
+    print(json.dumps({
+        "tenants": tenant_count,
+        "replies": expected,
+        "seconds": elapsed,
+        "replies_per_second": expected / elapsed,
+        "rss_before_kb": rss_before,
+        "rss_after_kb": rss_after,
+        "rss_peak_kb": rss_peak
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RSS and throughput of hosting several bots in one process")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rate-limit', type=float, default=LLM_RATE_LIMIT, help="LLM requests per second, 0 for no limit (default: LLM_RATE_LIMIT from config.py)")
+    parser.add_argument('--stubs', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--tenants', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--run-id', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stubs:
+        serve_stubs(args.port)
+        return
+    if args.tenants:
+        logging.disable(logging.WARNING)
+        asyncio.run(host(args.tenants, args.port, args.run_id, args.rate_limit))
+        return
+
+    stubs = subprocess.Popen([sys.executable, __file__, '--stubs', '--port', str(args.port)])
+    try:
+        time.sleep(1)
+        print(f"LLM rate limit: {args.rate_limit or 'none'} requests/s")
+        print(f"{'tenants':>8} {'replies':>8} {'seconds':>8} {'replies/s':>10} {'RSS MB':>8} {'peak MB':>8} {'MB/tenant':>10}")
+        for tenant_count in TENANT_COUNTS:
+            process = subprocess.run(
+                [sys.executable, __file__, '--tenants', str(tenant_count), '--port', str(args.port), '--run-id', f"run{tenant_count}",
+                 '--rate-limit', str(args.rate_limit)],
+                capture_output=True, text=True
+            )
+            if process.returncode != 0:
+                error = process.stderr.strip().splitlines()
+                sys.exit(f"{tenant_count} tenants failed: {error[-1] if error else process.returncode}")
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            per_tenant = (result['rss_after_kb'] - result['rss_before_kb']) / 1024 / tenant_count
+            print(f"{result['tenants']:>8} {result['replies']:>8} {result['seconds']:>8.2f} {result['replies_per_second']:>10.1f} "
+                  f"{result['rss_after_kb'] / 1024:>8.1f} {result['rss_peak_kb'] / 1024:>8.1f} {per_tenant:>10.2f}")
+    finally:
+        stubs.terminate()
+        stubs.wait()
+
+if __name__ == '__main__':
+    main()
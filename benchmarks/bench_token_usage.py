@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import token_usage
+from token_usage import record_usage, get_history_window, get_max_tokens, apply_max_tokens, format_usage, CALL_TYPES
+
+ITERATIONS = 200000
+CHATS = 1000
+
+personality = {
+    "api_url": "http://localhost/v1/chat/completions",
+    "prompt": "You are chatgpt.",
+    "temperature": 0.6,
+    "model": "openai/gpt-4o",
+    "max_tokens": 1024,
+    "daily_token_quota": 5000
+}
+response_json = {
+    "choices": [{"message": {"content": "Hello!"}}],
+    "usage": {"prompt_tokens": 120, "completion_tokens": 30, "total_tokens": 150}
+}
+history = [f"User: message {i}" for i in range(30)]
+
+# Baseline: building the payload as bot.py does without token accounting
+def build_payload(chat_id):
+    return {
+        "model": personality['model'],
+        "messages": [{"role": "system", "content": personality['prompt']}] + [{"role": "user", "content": msg} for msg in history],
+        "temperature": personality['temperature']
+    }
+
+# Same payload with the history budget, output cap and usage recording applied
+def build_payload_with_accounting(chat_id):
+    window = get_history_window("default", chat_id, personality, history)
+    payload = {
+        "model": personality['model'],
+        "messages": [{"role": "system", "content": personality['prompt']}] + [{"role": "user", "content": msg} for msg in window],
+        "temperature": personality['temperature']
+    }
+    apply_max_tokens(payload, "default", chat_id, personality)
+    record_usage("default", chat_id, "DefaultPersonality", CALL_TYPES[chat_id % len(CALL_TYPES)], response_json)
+    return payload
+
+# Check that throttling only ever lowers a chat's budgets, the repo has no test suite
+def check_budgets():
+    small = {"max_tokens": 32, "history_limit": 2, "daily_token_quota": 100}
+    record_usage("check", 1, "Small", "reply", {"usage": {"prompt_tokens": 150, "completion_tokens": 0}})
+    assert get_max_tokens("check", 1, small) == 32
+    assert get_history_window("check", 1, small, history) == history[-2:]
+    assert get_history_window("check", 2, {"history_limit": 0}, history) == []
+    token_usage.token_usage.clear()
+    token_usage.daily_token_usage.clear()
+
+def bench(func):
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        func(i % CHATS)
+    return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+def main():
+    check_budgets()
+    baseline = bench(build_payload)
+    token_usage.token_usage.clear()
+    token_usage.daily_token_usage.clear()
+    with_accounting = bench(build_payload_with_accounting)
+
+    start = time.perf_counter()
+    format_usage("default")
+    format_all = (time.perf_counter() - start) * 1e3
+
+    print(f"{ITERATIONS} calls over {CHATS} chats")
+    print(f"payload only:           {baseline:.2f} us/call")
+    print(f"payload + accounting:   {with_accounting:.2f} us/call")
+    print(f"accounting overhead:    {with_accounting - baseline:.2f} us/call")
+    print(f"/usage over all chats:  {format_all:.2f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -3,53 +3,44 @@ import aiohttp
 import json
 import asyncio
 import random
+import signal
 from datetime import datetime, timedelta
 import pytz
 from telegram import Update, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, JobQueue
-from config import API_KEY, TELEGRAM_BOT_TOKEN, YOUR_SITE_URL, YOUR_APP_NAME, ALLOWED_USER_IDS
-from personalities import personalities
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
+from config import API_KEY, YOUR_SITE_URL, YOUR_APP_NAME
+from tenants import load_tenants
+import llm_pool
+from token_usage import record_usage, get_history_cap, get_history_window, apply_max_tokens, apply_memory_check_max_tokens, format_usage
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Store current personality choice for each user
-user_personalities = {}
-# Store chat history for each user
-chat_histories = {}
-# Store last activity time for each user
-last_activity = {}
-# Store timezone for each user
-user_timezones = {}
-# Store memories for each user
-user_memories = {}
-# Store scheduler task status for each user
-scheduler_tasks = {}
-# Store message IDs for each user
-message_ids = {}
-# Store reminders for each user
-user_reminders = {}
-# Store daily reminders for each user
-user_daily_reminders = {}
-
-# Get the latest personality choice
-def get_latest_personality(chat_id):
-    return user_personalities.get(chat_id, "DefaultPersonality")
-
 # Decorator function to check user ID
 def allowed_users_only(func):
     async def wrapper(update: Update, context: CallbackContext):
         user_id = update.message.from_user.id
-        if user_id in ALLOWED_USER_IDS:
+        if user_id in context.bot_data["tenant"].allowed_user_ids:
             return await func(update, context)
         else:
             await update.message.reply_text("You do not have permission to use this bot.")
     return wrapper
 
+# Decorator function to check admin user ID
+def admin_users_only(func):
+    async def wrapper(update: Update, context: CallbackContext):
+        user_id = update.message.from_user.id
+        if user_id in context.bot_data["tenant"].admin_user_ids:
+            return await func(update, context)
+        else:
+            await update.message.reply_text("You do not have permission to use this command.")
+    return wrapper
+
 # /start command handler
 @allowed_users_only
 async def start(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
     await update.message.reply_text(
         'Welcome to the chatbot!\n'
@@ -61,22 +52,16 @@ async def start(update: Update, context: CallbackContext) -> None:
         'You can also set your timezone, for example /time Asia/Shanghai\n'
         'Use /retry to resend the last message\n'
     )
-    last_activity[chat_id] = datetime.now()
-
-    # Check if there is an ongoing scheduler task, if so, cancel it
-    if chat_id in scheduler_tasks:
-        scheduler_tasks[chat_id].cancel()
-        logger.info(f"Cancelled existing greeting scheduler task for chat_id: {chat_id}")
+    tenant.last_activity[chat_id] = datetime.now()
 
-    # Start a new scheduler task
-    logger.info(f"Starting new greeting scheduler task for chat_id: {chat_id}")
-    task = context.application.create_task(greeting_scheduler(chat_id, context))
-    scheduler_tasks[chat_id] = task
-    logger.info(f"Created greeting_scheduler task for chat_id: {chat_id}")
+    # Let the idle scheduler watch this chat, dropping any pending greeting
+    tenant.greeting_due[chat_id] = None
+    logger.info(f"Reset greeting schedule for {tenant.name} chat_id: {chat_id}")
 
 # /use command handler
 @allowed_users_only
 async def use_personality(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
     args = context.args
     if len(args) != 1:
@@ -84,8 +69,8 @@ async def use_personality(update: Update, context: CallbackContext) -> None:
         return
 
     personality_choice = args[0]
-    if personality_choice in personalities:
-        user_personalities[chat_id] = personality_choice
+    if personality_choice in tenant.personalities:
+        tenant.user_personalities[chat_id] = personality_choice
         await update.message.reply_text(f'Switched to {personality_choice} personality.')
         logger.info(f"User {chat_id} switched to personality {personality_choice}")
     else:
@@ -95,6 +80,7 @@ async def use_personality(update: Update, context: CallbackContext) -> None:
 # /time command handler
 @allowed_users_only
 async def set_time(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
     args = context.args
     if len(args) != 1:
@@ -103,9 +89,9 @@ async def set_time(update: Update, context: CallbackContext) -> None:
 
     timezone = args[0]
     try:
-        # Attempt to set timezone in user_timezones dictionary
+        # Attempt to set timezone in tenant.user_timezones dictionary
         pytz.timezone(timezone)
-        user_timezones[chat_id] = timezone
+        tenant.user_timezones[chat_id] = timezone
         await update.message.reply_text(f'Timezone set to {timezone}')
         logger.info(f"User {chat_id} set timezone to {timezone}")
     except pytz.UnknownTimeZoneError:
@@ -115,19 +101,21 @@ async def set_time(update: Update, context: CallbackContext) -> None:
 # /clear command handler
 @allowed_users_only
 async def clear_history(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
-    chat_histories[chat_id] = []
+    tenant.chat_histories[chat_id] = []
     await update.message.reply_text('Cleared current chat history.')
     logger.info(f"Cleared chat history for chat_id: {chat_id}")
 
 # /list command handler
 @allowed_users_only
 async def list_memories(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
     args = context.args
 
     if not args:
-        memories = user_memories.get(chat_id, [])
+        memories = tenant.user_memories.get(chat_id, [])
         if not memories:
             await update.message.reply_text('No memories stored.')
         else:
@@ -138,19 +126,19 @@ async def list_memories(update: Update, context: CallbackContext) -> None:
             index = int(args[0]) - 1
             new_memory = " ".join(args[1:])
             if new_memory:
-                if chat_id not in user_memories:
-                    user_memories[chat_id] = []
-                if 0 <= index < len(user_memories[chat_id]):
-                    user_memories[chat_id][index] = new_memory
-                elif index == len(user_memories[chat_id]):
-                    user_memories[chat_id].append(new_memory)
+                if chat_id not in tenant.user_memories:
+                    tenant.user_memories[chat_id] = []
+                if 0 <= index < len(tenant.user_memories[chat_id]):
+                    tenant.user_memories[chat_id][index] = new_memory
+                elif index == len(tenant.user_memories[chat_id]):
+                    tenant.user_memories[chat_id].append(new_memory)
                 else:
                     await update.message.reply_text('Invalid memory index.')
                     return
                 await update.message.reply_text('Memory updated.')
             else:
-                if chat_id in user_memories and 0 <= index < len(user_memories[chat_id]):
-                    del user_memories[chat_id][index]
+                if chat_id in tenant.user_memories and 0 <= index < len(tenant.user_memories[chat_id]):
+                    del tenant.user_memories[chat_id][index]
                     await update.message.reply_text('Memory deleted.')
                 else:
                     await update.message.reply_text('Invalid memory index.')
@@ -160,32 +148,33 @@ async def list_memories(update: Update, context: CallbackContext) -> None:
 # /retry command handler
 @allowed_users_only
 async def retry_last_response(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
 
     try:
         # Ensure there is at least one bot response in the chat history
-        if chat_id in chat_histories and len(chat_histories[chat_id]) > 1:
+        if chat_id in tenant.chat_histories and len(tenant.chat_histories[chat_id]) > 1:
             # Find the index of the last bot response
             last_bot_response_index = None
-            for i in range(len(chat_histories[chat_id]) - 1, -1, -1):
-                if chat_histories[chat_id][i].startswith("Bot:"):
+            for i in range(len(tenant.chat_histories[chat_id]) - 1, -1, -1):
+                if tenant.chat_histories[chat_id][i].startswith("Bot:"):
                     last_bot_response_index = i
                     break
 
             if last_bot_response_index is not None:
                 # Get the user's original message
                 last_user_message_index = last_bot_response_index - 1
-                if last_user_message_index >= 0 and chat_histories[chat_id][last_user_message_index].startswith("User:"):
-                    last_user_message = chat_histories[chat_id][last_user_message_index].split("User:", 1)[-1].strip()
+                if last_user_message_index >= 0 and tenant.chat_histories[chat_id][last_user_message_index].startswith("User:"):
+                    last_user_message = tenant.chat_histories[chat_id][last_user_message_index].split("User:", 1)[-1].strip()
 
                     # Remove the last bot response from the chat history
-                    last_bot_response = chat_histories[chat_id].pop(last_bot_response_index)
+                    last_bot_response = tenant.chat_histories[chat_id].pop(last_bot_response_index)
 
                     logger.info(f"Removed last bot response from chat history for chat_id {chat_id}: {last_bot_response}")
 
                     # Delete the last bot message from Telegram
-                    if chat_id in message_ids and message_ids[chat_id]:
-                        last_message_id = message_ids[chat_id].pop()
+                    if chat_id in tenant.message_ids and tenant.message_ids[chat_id]:
+                        last_message_id = tenant.message_ids[chat_id].pop()
                         try:
                             await context.bot.delete_message(chat_id=chat_id, message_id=last_message_id)
                             logger.info(f"Deleted message ID: {last_message_id} for chat_id {chat_id}")
@@ -209,6 +198,7 @@ async def retry_last_response(update: Update, context: CallbackContext) -> None:
 # /clock command handler
 @allowed_users_only
 async def set_clock(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
     args = context.args
     if len(args) < 2:
@@ -220,9 +210,9 @@ async def set_clock(update: Update, context: CallbackContext) -> None:
 
     try:
         reminder_time = datetime.strptime(time_str, "%H:%M").time()
-        if chat_id not in user_reminders:
-            user_reminders[chat_id] = []
-        user_reminders[chat_id].append((reminder_time, event))
+        if chat_id not in tenant.user_reminders:
+            tenant.user_reminders[chat_id] = []
+        tenant.user_reminders[chat_id].append((reminder_time, event))
         await update.message.reply_text(f'Reminder set at {time_str} to remind: {event}')
         logger.info(f"User {chat_id} set a reminder at {time_str} for: {event}")
     except ValueError:
@@ -232,15 +222,16 @@ async def set_clock(update: Update, context: CallbackContext) -> None:
 # /clocklist command handler
 @allowed_users_only
 async def list_clocks(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
-    reminders = user_reminders.get(chat_id, [])
+    reminders = tenant.user_reminders.get(chat_id, [])
     if not reminders:
         await update.message.reply_text('No reminders set.')
     else:
         reminders_text = "\n".join([f"{i + 1}. {time.strftime('%H:%M')} - {event}" for i, (time, event) in enumerate(reminders)])
         await update.message.reply_text(f"Reminder list:\n{reminders_text}")
 
-    daily_reminders = user_daily_reminders.get(chat_id, [])
+    daily_reminders = tenant.user_daily_reminders.get(chat_id, [])
     if daily_reminders:
         daily_reminders_text = "\n".join([f"{i + 1}. {time.strftime('%H:%M')} - {event}" for i, (time, event) in enumerate(daily_reminders)])
         await update.message.reply_text(f"Daily reminder list:\n{daily_reminders_text}")
@@ -248,6 +239,7 @@ async def list_clocks(update: Update, context: CallbackContext) -> None:
 # /clockeveryday command handler
 @allowed_users_only
 async def set_daily_clock(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
     args = context.args
     if len(args) < 2:
@@ -259,9 +251,9 @@ async def set_daily_clock(update: Update, context: CallbackContext) -> None:
 
     try:
         reminder_time = datetime.strptime(time_str, "%H:%M").time()
-        if chat_id not in user_daily_reminders:
-            user_daily_reminders[chat_id] = []
-        user_daily_reminders[chat_id].append((reminder_time, event))
+        if chat_id not in tenant.user_daily_reminders:
+            tenant.user_daily_reminders[chat_id] = []
+        tenant.user_daily_reminders[chat_id].append((reminder_time, event))
         await update.message.reply_text(f'Daily reminder set at {time_str} to remind: {event}')
         logger.info(f"User {chat_id} set a daily reminder at {time_str} for: {event}")
     except ValueError:
@@ -271,6 +263,7 @@ async def set_daily_clock(update: Update, context: CallbackContext) -> None:
 # /clockclear command handler
 @allowed_users_only
 async def clear_clock(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
     args = context.args
     if len(args) != 1:
@@ -279,8 +272,8 @@ async def clear_clock(update: Update, context: CallbackContext) -> None:
 
     try:
         index = int(args[0]) - 1
-        if chat_id in user_reminders and 0 <= index < len(user_reminders[chat_id]):
-            del user_reminders[chat_id][index]
+        if chat_id in tenant.user_reminders and 0 <= index < len(tenant.user_reminders[chat_id]):
+            del tenant.user_reminders[chat_id][index]
             await update.message.reply_text('Reminder deleted.')
         else:
             await update.message.reply_text('Invalid reminder index or the index does not correspond to a one-time reminder.')
@@ -290,6 +283,7 @@ async def clear_clock(update: Update, context: CallbackContext) -> None:
 # /clockclearevery command handler
 @allowed_users_only
 async def clear_daily_clock(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
     args = context.args
     if len(args) != 1:
@@ -298,60 +292,75 @@ async def clear_daily_clock(update: Update, context: CallbackContext) -> None:
 
     try:
         index = int(args[0]) - 1
-        if chat_id in user_daily_reminders and 0 <= index < len(user_daily_reminders[chat_id]):
-            del user_daily_reminders[chat_id][index]
+        if chat_id in tenant.user_daily_reminders and 0 <= index < len(tenant.user_daily_reminders[chat_id]):
+            del tenant.user_daily_reminders[chat_id][index]
             await update.message.reply_text('Daily reminder deleted.')
         else:
             await update.message.reply_text('Invalid reminder index.')
     except (ValueError, IndexError):
         await update.message.reply_text('Invalid reminder index.')
 
+# /usage command handler
+@admin_users_only
+async def show_usage(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
+    args = context.args
+    if len(args) > 1:
+        await update.message.reply_text('Usage: /usage [chat_id]')
+        return
+
+    if args:
+        try:
+            usage_chat_id = int(args[0])
+        except ValueError:
+            await update.message.reply_text('Invalid chat_id.')
+            return
+        await update.message.reply_text(format_usage(tenant.name, usage_chat_id))
+    else:
+        await update.message.reply_text(format_usage(tenant.name))
+
 # Message handler
 @allowed_users_only
 async def handle_message(update: Update, context: CallbackContext) -> None:
+    tenant = context.bot_data["tenant"]
     chat_id = update.message.chat_id
     message = update.message.text
 
     logger.info(f"Received message from {chat_id}: {message}")
 
     # Initialize chat history (if not already present)
-    if chat_id not in chat_histories:
-        chat_histories[chat_id] = []
+    if chat_id not in tenant.chat_histories:
+        tenant.chat_histories[chat_id] = []
 
     # Add new message to chat history
-    chat_histories[chat_id].append(f"User: {message}")
+    tenant.chat_histories[chat_id].append(f"User: {message}")
 
-    # Retain only the last 30 messages
-    if len(chat_histories[chat_id]) > 30:
-        chat_histories[chat_id].pop(0)
+    # Retain only the last messages needed by the largest history_limit (30 by default)
+    history_cap = get_history_cap(tenant.personalities)
+    if len(tenant.chat_histories[chat_id]) > history_cap:
+        del tenant.chat_histories[chat_id][:-history_cap]
 
     # Update last activity time
-    last_activity[chat_id] = datetime.now()
-
-    # Cancel current scheduler task
-    if chat_id in scheduler_tasks:
-        scheduler_tasks[chat_id].cancel()
-        logger.info(f"Cancelled existing greeting scheduler task for chat_id: {chat_id}")
+    tenant.last_activity[chat_id] = datetime.now()
 
-    # Start a new scheduler task
-    logger.info(f"Starting new greeting scheduler task for chat_id: {chat_id}")
-    task = context.application.create_task(greeting_scheduler(chat_id, context))
-    scheduler_tasks[chat_id] = task
-    logger.info(f"Created greeting_scheduler task for chat_id: {chat_id}")
+    # Let the idle scheduler watch this chat, dropping any pending greeting
+    tenant.greeting_due[chat_id] = None
+    logger.info(f"Reset greeting schedule for {tenant.name} chat_id: {chat_id}")
 
     await process_message(chat_id, message, update.message, context)
 
 # Function to process message, including memory checks
 async def process_message(chat_id, message, telegram_message, context):
+    tenant = context.bot_data["tenant"]
     # Get current personality choice
-    current_personality = get_latest_personality(chat_id)
+    current_personality = tenant.get_latest_personality(chat_id)
 
     # If current personality is undefined, use default personality
-    if current_personality not in personalities:
+    if current_personality not in tenant.personalities:
         current_personality = "DefaultPersonality"
 
     try:
-        personality = personalities[current_personality]
+        personality = tenant.personalities[current_personality]
     except KeyError:
         await telegram_message.reply_text(f"Personality not found: {current_personality}")
         logger.error(f"Personality not found {current_personality} for chat_id: {chat_id}")
@@ -364,137 +373,167 @@ async def process_message(chat_id, message, telegram_message, context):
     }
 
     # Prepare memory check payload (if there are memories)
-    memories = user_memories.get(chat_id, [])
+    memories = tenant.user_memories.get(chat_id, [])
+    # Trim history to the chat's budget, which tightens once its daily token quota is exceeded
+    history = get_history_window(tenant.name, chat_id, personality, tenant.chat_histories[chat_id])
     if memories:
         memory_check_payload = {
             "model": personality['model'],
-            "messages": [{"role": "user", "content": msg} for msg in chat_histories[chat_id]] + [{"role": "user", "content": f"Memory: {memory}"} for memory in memories] + [{"role": "user", "content": "Please determine the relevance between the user's message and the memories. If relevant, reply '1', if not, reply '2'."}],
+            "messages": [{"role": "user", "content": msg} for msg in history] + [{"role": "user", "content": f"Memory: {memory}"} for memory in memories] + [{"role": "user", "content": "Please determine the relevance between the user's message and the memories. If relevant, reply '1', if not, reply '2'."}],
             "temperature": personality['temperature']
         }
+        apply_memory_check_max_tokens(memory_check_payload, personality)
 
         logger.debug(f"Sending memory check payload to API for chat_id {chat_id}: {json.dumps(memory_check_payload, ensure_ascii=False)}")
 
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.post(personality['api_url'], headers=headers, json=memory_check_payload) as memory_check_response:
-                    memory_check_response.raise_for_status()
-                    memory_check_result = await memory_check_response.json()
-                    logger.debug(f"API response for memory check for chat_id {chat_id}: {memory_check_result}")
-
-                    memory_check_result = memory_check_result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-            except aiohttp.ClientResponseError as http_err:
-                logger.error(f"HTTP error occurred: {http_err}")
-                memory_check_result = "2"
-            except aiohttp.ClientError as req_err:
-                logger.error(f"Request error occurred: {req_err}")
-                memory_check_result = "2"
-            except json.JSONDecodeError as json_err:
-                logger.error(f"JSON decode error: {json_err}")
-                memory_check_result = "2"
-            except Exception as err:
-                logger.error(f"Error occurred: {err}")
-                memory_check_result = "2"
+        try:
+            async with llm_pool.post(personality['api_url'], headers=headers, json=memory_check_payload) as memory_check_response:
+                memory_check_response.raise_for_status()
+                memory_check_result = await memory_check_response.json()
+                logger.debug(f"API response for memory check for chat_id {chat_id}: {memory_check_result}")
+                record_usage(tenant.name, chat_id, current_personality, "memory_check", memory_check_result)
+
+                memory_check_result = memory_check_result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+        except aiohttp.ClientResponseError as http_err:
+            logger.error(f"HTTP error occurred: {http_err}")
+            memory_check_result = "2"
+        except aiohttp.ClientError as req_err:
+            logger.error(f"Request error occurred: {req_err}")
+            memory_check_result = "2"
+        except json.JSONDecodeError as json_err:
+            logger.error(f"JSON decode error: {json_err}")
+            memory_check_result = "2"
+        except Exception as err:
+            logger.error(f"Error occurred: {err}")
+            memory_check_result = "2"
 
         # If memory check result contains "1", include memories in the final payload
         if "1" in memory_check_result:
             final_payload = {
                 "model": personality['model'],
-                "messages": [{"role": "system", "content": personality['prompt']}] + [{"role": "user", "content": msg} for msg in chat_histories[chat_id]] + [{"role": "user", "content": "Each memory is separate, do not confuse them. Use only one relevant memory per response."}] + [{"role": "user", "content": f"Memory: {memory}"} for memory in memories],
+                "messages": [{"role": "system", "content": personality['prompt']}] + [{"role": "user", "content": msg} for msg in history] + [{"role": "user", "content": "Each memory is separate, do not confuse them. Use only one relevant memory per response."}] + [{"role": "user", "content": f"Memory: {memory}"} for memory in memories],
                 "temperature": personality['temperature']
             }
         else:
             final_payload = {
                 "model": personality['model'],
-                "messages": [{"role": "system", "content": personality['prompt']}] + [{"role": "user", "content": msg} for msg in chat_histories[chat_id]],
+                "messages": [{"role": "system", "content": personality['prompt']}] + [{"role": "user", "content": msg} for msg in history],
                 "temperature": personality['temperature']
             }
     else:
         final_payload = {
             "model": personality['model'],
-            "messages": [{"role": "system", "content": personality['prompt']}] + [{"role": "user", "content": msg} for msg in chat_histories[chat_id]],
+            "messages": [{"role": "system", "content": personality['prompt']}] + [{"role": "user", "content": msg} for msg in history],
             "temperature": personality['temperature']
         }
 
-    logger.debug(f"Sending final payload to API for chat_id {chat_id}: {json.dumps(final_payload, ensure_ascii=False)}")
+    apply_max_tokens(final_payload, tenant.name, chat_id, personality)
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(personality['api_url'], headers=headers, json=final_payload) as response:
-                response.raise_for_status()  # Check if HTTP request was successful
-                response_json = await response.json()
-                logger.debug(f"API response for chat_id {chat_id}: {response_json}")
+    logger.debug(f"Sending final payload to API for chat_id {chat_id}: {json.dumps(final_payload, ensure_ascii=False)}")
 
-                reply = response_json.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-        except aiohttp.ClientResponseError as http_err:
-            logger.error(f"HTTP error occurred: {http_err}")
-            reply = f"HTTP error occurred: {http_err}"
-        except aiohttp.ClientError as req_err:
-            logger.error(f"Request error occurred: {req_err}")
-            reply = f"Request error occurred: {req_err}"
-        except json.JSONDecodeError as json_err:
-            logger.error(f"JSON decode error: {json_err}")
-            reply = f"JSON decode error: {json_err}"
-        except Exception as err:
-            logger.error(f"Error occurred: {err}")
-            reply = f"Error occurred: {err}"
+    try:
+        async with llm_pool.post(personality['api_url'], headers=headers, json=final_payload) as response:
+            response.raise_for_status()  # Check if HTTP request was successful
+            response_json = await response.json()
+            logger.debug(f"API response for chat_id {chat_id}: {response_json}")
+            record_usage(tenant.name, chat_id, current_personality, "reply", response_json)
+
+            reply = response_json.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+    except aiohttp.ClientResponseError as http_err:
+        logger.error(f"HTTP error occurred: {http_err}")
+        reply = f"HTTP error occurred: {http_err}"
+    except aiohttp.ClientError as req_err:
+        logger.error(f"Request error occurred: {req_err}")
+        reply = f"Request error occurred: {req_err}"
+    except json.JSONDecodeError as json_err:
+        logger.error(f"JSON decode error: {json_err}")
+        reply = f"JSON decode error: {json_err}"
+    except Exception as err:
+        logger.error(f"Error occurred: {err}")
+        reply = f"Error occurred: {err}"
 
     # Remove unnecessary prefix (e.g., name)
     if "：" in reply:
         reply = reply.split("：", 1)[-1].strip()
 
     # Add API response to chat history
-    chat_histories[chat_id].append(f"Bot: {reply}")
+    tenant.chat_histories[chat_id].append(f"Bot: {reply}")
 
     logger.info(f"Replying to {chat_id}: {reply}")
 
     try:
         sent_message = await telegram_message.reply_text(reply)
         # Record message ID
-        if chat_id not in message_ids:
-            message_ids[chat_id] = []
-        message_ids[chat_id].append(sent_message.message_id)
+        if chat_id not in tenant.message_ids:
+            tenant.message_ids[chat_id] = []
+        tenant.message_ids[chat_id].append(sent_message.message_id)
     except Exception as err:
         logger.error(f"Failed to send message: {err}")
 
-# Reminder scheduler
-async def reminder_scheduler(context: CallbackContext):
+# Shared scheduler for reminders and idle greetings of all tenants
+async def scheduler(tenants):
     while True:
-        await asyncio.sleep(60)  # Check reminders every 60 seconds
+        await asyncio.sleep(60)  # Check reminders and idle chats every 60 seconds
         now = datetime.now(pytz.utc)
 
-        for chat_id, reminders in list(user_reminders.items()):
-            timezone = user_timezones.get(chat_id, 'UTC')
-            current_time = now.astimezone(pytz.timezone(timezone)).time()
-
-            reminders_to_remove = []
-            for reminder_time, reminder_text in reminders:
-                if reminder_time <= current_time < (datetime.combine(datetime.today(), reminder_time) + timedelta(minutes=1)).time():
-                    await send_reminder(chat_id, reminder_text, context)
-                    reminders_to_remove.append((reminder_time, reminder_text))
-
-            for reminder in reminders_to_remove:
-                user_reminders[chat_id].remove(reminder)
-
-        for chat_id, reminders in list(user_daily_reminders.items()):
-            timezone = user_timezones.get(chat_id, 'UTC')
-            current_time = now.astimezone(pytz.timezone(timezone)).time()
-
-            for reminder_time, reminder_text in reminders:
-                if reminder_time <= current_time < (datetime.combine(datetime.today(), reminder_time) + timedelta(minutes=1)).time():
-                    await send_reminder(chat_id, reminder_text, context)
+        for tenant in tenants:
+            # One tenant's failure must not stop reminders and greetings for the others
+            try:
+                check_reminders(tenant, now)
+                check_idle_chats(tenant)
+            except Exception:
+                logger.exception(f"Scheduler error for bot {tenant.name}")
+
+# Start a reminder task for each due reminder of a tenant
+def check_reminders(tenant, now):
+    for chat_id, reminders in list(tenant.user_reminders.items()):
+        timezone = tenant.user_timezones.get(chat_id, 'UTC')
+        current_time = now.astimezone(pytz.timezone(timezone)).time()
+
+        reminders_to_remove = []
+        for reminder_time, reminder_text in reminders:
+            if reminder_time <= current_time < (datetime.combine(datetime.today(), reminder_time) + timedelta(minutes=1)).time():
+                tenant.application.create_task(send_reminder(tenant, chat_id, reminder_text))
+                reminders_to_remove.append((reminder_time, reminder_text))
+
+        for reminder in reminders_to_remove:
+            tenant.user_reminders[chat_id].remove(reminder)
+
+    for chat_id, reminders in list(tenant.user_daily_reminders.items()):
+        timezone = tenant.user_timezones.get(chat_id, 'UTC')
+        current_time = now.astimezone(pytz.timezone(timezone)).time()
+
+        for reminder_time, reminder_text in reminders:
+            if reminder_time <= current_time < (datetime.combine(datetime.today(), reminder_time) + timedelta(minutes=1)).time():
+                tenant.application.create_task(send_reminder(tenant, chat_id, reminder_text))
+
+# Schedule a greeting for chats inactive for over 1 hour, and start a greeting task when it is due
+def check_idle_chats(tenant):
+    now = datetime.now()
+    for chat_id, due in list(tenant.greeting_due.items()):
+        if due is None:
+            if chat_id in tenant.last_activity and (now - tenant.last_activity[chat_id]).total_seconds() >= 3600:
+                logger.info(f"{tenant.name} chat_id {chat_id} has been inactive for over 1 hour.")
+                wait_time = random.randint(3600, 14400)  # Random wait between 1 to 4 hours
+                logger.info(f"Waiting {wait_time} seconds before sending greeting")
+                tenant.greeting_due[chat_id] = now + timedelta(seconds=wait_time)
+        elif now >= due:
+            tenant.greeting_due[chat_id] = None
+            tenant.application.create_task(send_greeting(tenant, chat_id))
 
 # Function to send reminders
-async def send_reminder(chat_id, reminder_text, context: CallbackContext):
-    logger.info(f"Reminder time, sending reminder to chat_id {chat_id}: {reminder_text}")
+async def send_reminder(tenant, chat_id, reminder_text):
+    logger.info(f"Reminder time, sending reminder to {tenant.name} chat_id {chat_id}: {reminder_text}")
+    bot = tenant.application.bot
 
     # Get current personality choice
-    current_personality = get_latest_personality(chat_id)
-    if current_personality not in personalities:
+    current_personality = tenant.get_latest_personality(chat_id)
+    if current_personality not in tenant.personalities:
         current_personality = "DefaultPersonality"
     try:
-        personality = personalities[current_personality]
+        personality = tenant.personalities[current_personality]
     except KeyError:
-        await context.bot.send_message(chat_id=chat_id, text=f"Personality not found: {current_personality}")
+        await bot.send_message(chat_id=chat_id, text=f"Personality not found: {current_personality}")
         return
 
     # Convert all personality parameters to string
@@ -508,148 +547,146 @@ async def send_reminder(chat_id, reminder_text, context: CallbackContext):
         "messages": messages,
         "temperature": personality['temperature']
     }
+    apply_max_tokens(payload, tenant.name, chat_id, personality)
     headers = {
         "Authorization": f"Bearer {API_KEY}",
         "HTTP-Referer": YOUR_SITE_URL,  # Optional
         "X-Title": YOUR_APP_NAME  # Optional
     }
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(personality['api_url'], headers=headers, json=payload) as response:
-                response.raise_for_status()
-                response_json = await response.json()
-                reply = response_json.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-                if "：" in reply:
-                    reply = reply.split("：", 1)[-1].strip()
-                sent_message = await context.bot.send_message(chat_id=chat_id, text=reply)
-                # Add reminder content and reply content to chat history
-                if chat_id not in chat_histories:
-                    chat_histories[chat_id] = []
-                chat_histories[chat_id].append(f"Reminder: {reminder_text}")
-                chat_histories[chat_id].append(f"Bot: {reply}")
-
-                # Record message ID
-                if chat_id not in message_ids:
-                    message_ids[chat_id] = []
-                message_ids[chat_id].append(sent_message.message_id)
-
-                last_activity[chat_id] = datetime.now()  # Update last activity time
-                logger.info(f"Sent reminder to chat_id {chat_id}: {reply}")
-        except aiohttp.ClientResponseError as http_err:
-            logger.error(f"HTTP error occurred: {http_err}")
-        except aiohttp.ClientError as req_err:
-            logger.error(f"Request error occurred: {req_err}")
-        except json.JSONDecodeError as json_err:
-            logger.error(f"JSON decode error: {json_err}")
-        except Exception as err:
-            logger.error(f"Error occurred: {err}, message content: {reminder_text}, chat_id: {chat_id}")
+    try:
+        async with llm_pool.post(personality['api_url'], headers=headers, json=payload) as response:
+            response.raise_for_status()
+            response_json = await response.json()
+            record_usage(tenant.name, chat_id, current_personality, "reminder", response_json)
+            reply = response_json.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+            if "：" in reply:
+                reply = reply.split("：", 1)[-1].strip()
+            sent_message = await bot.send_message(chat_id=chat_id, text=reply)
+            # Add reminder content and reply content to chat history
+            if chat_id not in tenant.chat_histories:
+                tenant.chat_histories[chat_id] = []
+            tenant.chat_histories[chat_id].append(f"Reminder: {reminder_text}")
+            tenant.chat_histories[chat_id].append(f"Bot: {reply}")
+
+            # Record message ID
+            if chat_id not in tenant.message_ids:
+                tenant.message_ids[chat_id] = []
+            tenant.message_ids[chat_id].append(sent_message.message_id)
+
+            tenant.last_activity[chat_id] = datetime.now()  # Update last activity time
+            logger.info(f"Sent reminder to chat_id {chat_id}: {reply}")
+    except aiohttp.ClientResponseError as http_err:
+        logger.error(f"HTTP error occurred: {http_err}")
+    except aiohttp.ClientError as req_err:
+        logger.error(f"Request error occurred: {req_err}")
+    except json.JSONDecodeError as json_err:
+        logger.error(f"JSON decode error: {json_err}")
+    except Exception as err:
+        logger.error(f"Error occurred: {err}, message content: {reminder_text}, chat_id: {chat_id}")
+
+# Function to send a proactive greeting
+async def send_greeting(tenant, chat_id):
+    bot = tenant.application.bot
+
+    # Get user's timezone
+    timezone = tenant.user_timezones.get(chat_id, 'UTC')
+    local_time = datetime.now(pytz.timezone(timezone)).strftime("%Y-%m-%d %H:%M:%S")
+    greeting_message = f"It is now {local_time}, please generate and reply with a greeting or share your daily life. Respond according to the given personality and role settings, here are some examples."
+
+    # Generate greeting
+    examples = [
+        "0:00-3:59: 'Ask if I'm still awake and describe how you miss me.'",
+        "4:00-5:59: 'Say good morning and mention you woke up early.'",
+        "6:00-8:59: 'Greet me in the morning.'",
+        "9:00-10:59: 'Greet me and ask about my plans for today.'",
+        "11:00-12:59: 'Ask if I've had lunch.'",
+        "13:00-16:59: 'Talk about your work and express how you miss me.'",
+        "17:00-19:59: 'Ask if I've had dinner.'",
+        "20:00-21:59: 'Describe your day or the beautiful evening and ask about my day.'",
+        "22:00-23:59: 'Say goodnight.'",
+        "Share daily life: 'Share your daily life or work.'"
+    ]
+    greeting_message += "\nRespond according to the rules of the examples, do not repeat the content of the examples, express it in your own way:\n" + "\n".join(examples)
 
-# Greeting scheduler
-async def greeting_scheduler(chat_id, context: CallbackContext):
-    logger.info(f"Starting greeting_scheduler for chat_id: {chat_id}")
-    while True:
-        await asyncio.sleep(600)  # Check for new messages every 3600 seconds
-        logger.info(f"Checking last activity time for chat_id: {chat_id}")
-        if chat_id in last_activity:
-            delta = datetime.now() - last_activity[chat_id]
-            logger.info(f"Time since last activity: {delta.total_seconds()} seconds")
-            if delta.total_seconds() >= 3600:  # Last activity time is over 1 hour
-                logger.info(f"chat_id {chat_id} has been inactive for over 1 hour.")
-                wait_time = random.randint(3600, 14400)  # Random wait between 1 to 4 hours
-                logger.info(f"Waiting {wait_time} seconds before sending greeting")
-                await asyncio.sleep(wait_time)
-
-                # Get user's timezone
-                timezone = user_timezones.get(chat_id, 'UTC')
-                local_time = datetime.now(pytz.timezone(timezone)).strftime("%Y-%m-%d %H:%M:%S")
-                greeting_message = f"It is now {local_time}, please generate and reply with a greeting or share your daily life. Respond according to the given personality and role settings, here are some examples."
-
-                # Generate greeting
-                examples = [
-                    "0:00-3:59: 'Ask if I'm still awake and describe how you miss me.'",
-                    "4:00-5:59: 'Say good morning and mention you woke up early.'",
-                    "6:00-8:59: 'Greet me in the morning.'",
-                    "9:00-10:59: 'Greet me and ask about my plans for today.'",
-                    "11:00-12:59: 'Ask if I've had lunch.'",
-                    "13:00-16:59: 'Talk about your work and express how you miss me.'",
-                    "17:00-19:59: 'Ask if I've had dinner.'",
-                    "20:00-21:59: 'Describe your day or the beautiful evening and ask about my day.'",
-                    "22:00-23:59: 'Say goodnight.'",
-                    "Share daily life: 'Share your daily life or work.'"
-                ]
-                greeting_message += "\nRespond according to the rules of the examples, do not repeat the content of the examples, express it in your own way:\n" + "\n".join(examples)
-
-                logger.info(f"Sending greeting message to chat_id {chat_id}: {greeting_message}")
-
-                # Get current personality choice
-                current_personality = get_latest_personality(chat_id)
-                if current_personality not in personalities:
-                    current_personality = "DefaultPersonality"
-                try:
-                    personality = personalities[current_personality]
-                except KeyError:
-                    await context.bot.send_message(chat_id=chat_id, text=f"Personality not found: {current_personality}")
-                    continue
-
-                messages = [{"role": "system", "content": personality['prompt']}, {"role": "user", "content": greeting_message}]
-                payload = {
-                    "model": personality['model'],
-                    "messages": messages,
-                    "temperature": personality['temperature']
-                }
-                headers = {
-                    "Authorization": f"Bearer {API_KEY}",
-                    "HTTP-Referer": YOUR_SITE_URL,  # Optional
-                    "X-Title": YOUR_APP_NAME  # Optional
-                }
-
-                logger.debug(f"Sending payload to API for chat_id {chat_id}: {json.dumps(payload, ensure_ascii=False)}")
-
-                async with aiohttp.ClientSession() as session:
-                    try:
-                        async with session.post(personality['api_url'], headers=headers, json=payload) as response:
-                            response.raise_for_status()
-                            response_json = await response.json()
-                            logger.debug(f"API response for chat_id {chat_id}: {response_json}")
-
-                            reply = response_json.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-                            if "：" in reply:
-                                reply = reply.split("：", 1)[-1].strip()
-                            await context.bot.send_message(chat_id=chat_id, text=reply)
-
-                            # Add proactive greeting to chat history
-                            chat_histories[chat_id].append(f"Bot: {reply}")
-                            last_activity[chat_id] = datetime.now()  # Update last activity time
-                            logger.info(f"Sent greeting to chat_id {chat_id}: {reply}")
-                    except aiohttp.ClientResponseError as http_err:
-                        logger.error(f"HTTP error occurred: {http_err}")
-                    except aiohttp.ClientError as req_err:
-                        logger.error(f"Request error occurred: {req_err}")
-                    except json.JSONDecodeError as json_err:
-                        logger.error(f"JSON decode error: {json_err}")
-                    except Exception as err:
-                        logger.error(f"Error occurred: {err}")
+    logger.info(f"Sending greeting message to {tenant.name} chat_id {chat_id}: {greeting_message}")
 
-# Main function
-def main() -> None:
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-
-    # Set commands
-    commands = [
-        BotCommand("start", "Start the bot"),
-        BotCommand("use", "Choose a personality"),
-        BotCommand("clear", "Clear the current chat history"),
-        BotCommand("time", "Set timezone"),
-        BotCommand("list", "List and manage memories"),
-        BotCommand("retry", "Retry the last message"),
-        BotCommand("clock", "Set a reminder"),
-        BotCommand("clocklist", "View the reminder list"),
-        BotCommand("clockeveryday", "Set a daily reminder"),
-        BotCommand("clockclear", "Cancel a reminder"),
-        BotCommand("clockclearevery", "Cancel a daily reminder")
-    ]
-    application.bot.set_my_commands(commands)
+    # Get current personality choice
+    current_personality = tenant.get_latest_personality(chat_id)
+    if current_personality not in tenant.personalities:
+        current_personality = "DefaultPersonality"
+    try:
+        personality = tenant.personalities[current_personality]
+    except KeyError:
+        await bot.send_message(chat_id=chat_id, text=f"Personality not found: {current_personality}")
+        return
+
+    messages = [{"role": "system", "content": personality['prompt']}, {"role": "user", "content": greeting_message}]
+    payload = {
+        "model": personality['model'],
+        "messages": messages,
+        "temperature": personality['temperature']
+    }
+    apply_max_tokens(payload, tenant.name, chat_id, personality)
+    headers = {
+        "Authorization": f"Bearer {API_KEY}",
+        "HTTP-Referer": YOUR_SITE_URL,  # Optional
+        "X-Title": YOUR_APP_NAME  # Optional
+    }
+
+    logger.debug(f"Sending payload to API for chat_id {chat_id}: {json.dumps(payload, ensure_ascii=False)}")
+
+    try:
+        async with llm_pool.post(personality['api_url'], headers=headers, json=payload) as response:
+            response.raise_for_status()
+            response_json = await response.json()
+            logger.debug(f"API response for chat_id {chat_id}: {response_json}")
+            record_usage(tenant.name, chat_id, current_personality, "greeting", response_json)
+
+            reply = response_json.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+            if "：" in reply:
+                reply = reply.split("：", 1)[-1].strip()
+            await bot.send_message(chat_id=chat_id, text=reply)
+
+            # Add proactive greeting to chat history
+            if chat_id not in tenant.chat_histories:
+                tenant.chat_histories[chat_id] = []
+            tenant.chat_histories[chat_id].append(f"Bot: {reply}")
+            tenant.last_activity[chat_id] = datetime.now()  # Update last activity time
+            logger.info(f"Sent greeting to chat_id {chat_id}: {reply}")
+    except aiohttp.ClientResponseError as http_err:
+        logger.error(f"HTTP error occurred: {http_err}")
+    except aiohttp.ClientError as req_err:
+        logger.error(f"Request error occurred: {req_err}")
+    except json.JSONDecodeError as json_err:
+        logger.error(f"JSON decode error: {json_err}")
+    except Exception as err:
+        logger.error(f"Error occurred: {err}")
+
+# Bot commands shown in the Telegram menu
+commands = [
+    BotCommand("start", "Start the bot"),
+    BotCommand("use", "Choose a personality"),
+    BotCommand("clear", "Clear the current chat history"),
+    BotCommand("time", "Set timezone"),
+    BotCommand("list", "List and manage memories"),
+    BotCommand("retry", "Retry the last message"),
+    BotCommand("clock", "Set a reminder"),
+    BotCommand("clocklist", "View the reminder list"),
+    BotCommand("clockeveryday", "Set a daily reminder"),
+    BotCommand("clockclear", "Cancel a reminder"),
+    BotCommand("clockclearevery", "Cancel a daily reminder"),
+    BotCommand("usage", "View token usage (admin only)")
+]
+
+# Build the Telegram application for a tenant
+def build_application(tenant):
+    builder = Application.builder().token(tenant.token)
+    if tenant.base_url:
+        builder = builder.base_url(tenant.base_url)
+    application = builder.build()
+    application.bot_data["tenant"] = tenant
+    tenant.application = application
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("use", use_personality))
@@ -662,13 +699,74 @@ def main() -> None:
     application.add_handler(CommandHandler("clockeveryday", set_daily_clock))
     application.add_handler(CommandHandler("clockclear", clear_clock))
     application.add_handler(CommandHandler("clockclearevery", clear_daily_clock))
+    application.add_handler(CommandHandler("usage", show_usage))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+# Start polling for a tenant
+async def start_application(application):
+    await application.initialize()
+    await application.bot.set_my_commands(commands)
+    await application.updater.start_polling()
+    await application.start()
+    logger.info(f"Started bot {application.bot_data['tenant'].name}")
+
+# Stop polling for a tenant, also cleaning up a tenant that failed to start
+async def stop_application(application):
+    if application.updater.running:
+        await application.updater.stop()
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+
+# Run all tenants in this event loop until stop_event is set, sharing the LLM pool and scheduler
+async def run_tenants(tenants, stop_event=None):
+    applications = [build_application(tenant) for tenant in tenants]
+    scheduler_task = None
+    try:
+        # Start each tenant separately so one bad token does not stop the other bots
+        results = await asyncio.gather(*[start_application(application) for application in applications], return_exceptions=True)
+        started = []
+        for application, result in zip(applications, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Failed to start bot {application.bot_data['tenant'].name}: {result}")
+            else:
+                started.append(application)
+        if not started:
+            # Exit non-zero so a service manager sees the failure, e.g. a bad TELEGRAM_BOT_TOKEN
+            raise RuntimeError("No bot could be started") from results[0]
+
+        # Start the shared reminder and idle greeting scheduler
+        scheduler_task = asyncio.create_task(scheduler([application.bot_data["tenant"] for application in started]))
+        await (stop_event or asyncio.Event()).wait()
+    finally:
+        if scheduler_task is not None:
+            scheduler_task.cancel()
+        results = await asyncio.gather(*[stop_application(application) for application in applications], return_exceptions=True)
+        for application, result in zip(applications, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Failed to stop bot {application.bot_data['tenant'].name}: {result}")
+        await llm_pool.close()
+
+# Run all tenants until SIGINT, SIGTERM or SIGABRT, then stop them cleanly
+async def run_until_stopped(tenants):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Signal handlers are not available on Windows, Ctrl+C still raises KeyboardInterrupt
+            pass
+    await run_tenants(tenants, stop_event)
 
-    # Start reminder scheduler task
-    job_queue = application.job_queue
-    job_queue.run_repeating(reminder_scheduler, interval=60, first=10)
-
-    application.run_polling()
+# Main function
+def main() -> None:
+    try:
+        asyncio.run(run_until_stopped(load_tenants()))
+    except KeyboardInterrupt:
+        pass
+    logger.info("Bot stopped")
 
 if __name__ == '__main__':
     main()
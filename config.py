@@ -1,6 +1,16 @@
 API_KEY = ''
 TELEGRAM_BOT_TOKEN = ''
 ALLOWED_USER_IDS = []  # Replace with allowed user IDs
+ADMIN_USER_IDS = []  # Replace with user IDs allowed to use /usage
 
 YOUR_SITE_URL = ""  # Optional
 YOUR_APP_NAME = ""  # Optional
+
+# Optional, host several bots in one process. When set, TELEGRAM_BOT_TOKEN, ALLOWED_USER_IDS and ADMIN_USER_IDS are ignored.
+# Each entry: {"name": "bot1", "token": "...", "allowed_user_ids": [], "admin_user_ids": [], "personalities": {...}, "base_url": "..."}
+# "admin_user_ids", "personalities" and "base_url" are optional. Personalities default to personalities.py and must include DefaultPersonality.
+# base_url points the bot at another Bot API server, e.g. "http://localhost:8081/bot" for a self-hosted one
+TENANTS = []
+
+LLM_MAX_CONNECTIONS = 100  # Connections to the LLM APIs, shared by all bots
+LLM_RATE_LIMIT = 0  # LLM requests per second, shared by all bots, 0 for no limit
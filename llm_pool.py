@@ -0,0 +1,61 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+import aiohttp
+from config import LLM_MAX_CONNECTIONS, LLM_RATE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Token bucket limiting how many requests per second are started
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Session and rate limiter shared by every bot in the process, created on first use
+_session = None
+_rate_limiter = None
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=LLM_MAX_CONNECTIONS))
+        logger.info(f"Created shared LLM session with {LLM_MAX_CONNECTIONS} connections")
+    return _session
+
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(LLM_RATE_LIMIT)
+    return _rate_limiter
+
+# Send a POST request to an LLM API through the shared session and rate limiter
+@asynccontextmanager
+async def post(url, **kwargs):
+    await get_rate_limiter().acquire()
+    async with get_session().post(url, **kwargs) as response:
+        yield response
+
+# Close the shared session
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
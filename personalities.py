@@ -9,6 +9,8 @@ personalities = {
         "api_url": "https://openrouter.ai/api/v1/chat/completions",
         "prompt": "Write the prompt here.",
         "temperature": 1,
-        "model": "openai/gpt-4o"
+        "model": "openai/gpt-4o",
+        "max_tokens": 1024,  # Optional, output limit per reply
+        "daily_token_quota": 200000  # Optional, tokens per chat per day before budgets are tightened
     },
 }
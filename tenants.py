@@ -0,0 +1,67 @@
+from config import TELEGRAM_BOT_TOKEN, ALLOWED_USER_IDS, ADMIN_USER_IDS, TENANTS
+from personalities import personalities as default_personalities
+
+# A bot hosted in this process, with its own allowed users, personalities and chat state
+class Tenant:
+    def __init__(self, name, token, allowed_user_ids, admin_user_ids=(), personalities=None, base_url=None):
+        self.name = name
+        self.token = token
+        self.allowed_user_ids = set(allowed_user_ids)
+        self.admin_user_ids = set(admin_user_ids)
+        self.personalities = personalities or default_personalities
+        # Optional Bot API server URL, e.g. a self-hosted server
+        self.base_url = base_url
+        # Telegram application, set when the bot is started
+        self.application = None
+
+        # Store current personality choice for each user
+        self.user_personalities = {}
+        # Store chat history for each user
+        self.chat_histories = {}
+        # Store last activity time for each user
+        self.last_activity = {}
+        # Store timezone for each user
+        self.user_timezones = {}
+        # Store memories for each user
+        self.user_memories = {}
+        # Store pending greeting time for each user watched by the idle scheduler (None until the chat goes idle)
+        self.greeting_due = {}
+        # Store message IDs for each user
+        self.message_ids = {}
+        # Store reminders for each user
+        self.user_reminders = {}
+        # Store daily reminders for each user
+        self.user_daily_reminders = {}
+
+    # Get the latest personality choice
+    def get_latest_personality(self, chat_id):
+        return self.user_personalities.get(chat_id, "DefaultPersonality")
+
+# Build the tenants from config.py, a single bot unless TENANTS is set
+def load_tenants():
+    if not TENANTS:
+        return [Tenant("default", TELEGRAM_BOT_TOKEN, ALLOWED_USER_IDS, ADMIN_USER_IDS)]
+
+    tenants = []
+    for i, tenant_config in enumerate(TENANTS):
+        tenants.append(Tenant(
+            tenant_config.get("name", f"bot{i + 1}"),
+            tenant_config["token"],
+            tenant_config.get("allowed_user_ids", []),
+            tenant_config.get("admin_user_ids", []),
+            tenant_config.get("personalities"),
+            tenant_config.get("base_url")
+        ))
+
+    names = [tenant.name for tenant in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Tenant names must be unique: {names}")
+    # Two bots polling one token make Telegram reject getUpdates with a conflict
+    tokens = [tenant.token for tenant in tenants]
+    if len(set(tokens)) != len(tokens):
+        raise ValueError("Tenant tokens must be unique")
+    # DefaultPersonality is the fallback for every chat without a /use choice
+    for tenant in tenants:
+        if "DefaultPersonality" not in tenant.personalities:
+            raise ValueError(f"Personalities of tenant {tenant.name} must include DefaultPersonality")
+    return tenants
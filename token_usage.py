@@ -0,0 +1,142 @@
+import logging
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+# Call types recorded for each API request
+CALL_TYPES = ("memory_check", "reply", "reminder", "greeting")
+
+# Number of history messages sent to the API when a personality does not set history_limit
+DEFAULT_HISTORY_LIMIT = 30
+# A throttled chat never gets less history than this
+MIN_HISTORY_LIMIT = 4
+# Output cap used for throttled chats whose personality does not set max_tokens
+THROTTLED_MAX_TOKENS = 512
+# A throttled chat never gets a smaller output cap than this
+MIN_MAX_TOKENS = 64
+# Number of chats listed by /usage, keeping the reply under Telegram's message length limit
+USAGE_TOP_CHATS = 20
+
+# Store total token usage for each (tenant, chat_id, personality, call_type)
+token_usage = {}
+# Store today's token usage for each (tenant, chat_id) as [date, tokens]
+daily_token_usage = {}
+
+# Record the usage field of an API response, returns the total tokens of the call
+def record_usage(tenant_name, chat_id, personality_name, call_type, response_json):
+    usage = response_json.get('usage') or {}
+    prompt_tokens = usage.get('prompt_tokens') or 0
+    completion_tokens = usage.get('completion_tokens') or 0
+
+    key = (tenant_name, chat_id, personality_name, call_type)
+    totals = token_usage.get(key)
+    if totals is None:
+        totals = token_usage[key] = [0, 0, 0]
+    totals[0] += prompt_tokens
+    totals[1] += completion_tokens
+    totals[2] += 1
+
+    tokens = prompt_tokens + completion_tokens
+    today = date.today()
+    daily = daily_token_usage.get((tenant_name, chat_id))
+    if daily is None or daily[0] != today:
+        daily_token_usage[(tenant_name, chat_id)] = [today, tokens]
+    else:
+        daily[1] += tokens
+
+    logger.debug(f"Recorded {call_type} usage for {tenant_name} chat_id {chat_id} ({personality_name}): prompt={prompt_tokens}, completion={completion_tokens}")
+    return tokens
+
+# Get the number of tokens a chat has used today
+def get_daily_usage(tenant_name, chat_id):
+    daily = daily_token_usage.get((tenant_name, chat_id))
+    if daily is None or daily[0] != date.today():
+        return 0
+    return daily[1]
+
+# Get how many times a chat has exceeded its personality's daily quota (0 if within quota)
+def get_quota_overshoot(tenant_name, chat_id, personality):
+    quota = personality.get('daily_token_quota')
+    if not quota:
+        return 0
+    return get_daily_usage(tenant_name, chat_id) // quota
+
+# Get the number of history messages to send, halved for each multiple of the quota used
+def get_history_limit(tenant_name, chat_id, personality):
+    limit = personality.get('history_limit', DEFAULT_HISTORY_LIMIT)
+    overshoot = get_quota_overshoot(tenant_name, chat_id, personality)
+    if overshoot:
+        # The floor never raises the limit above the personality's own value
+        limit = min(limit, max(MIN_HISTORY_LIMIT, limit >> overshoot))
+    return limit
+
+# Get the max_tokens for a reply, halved for each multiple of the quota used (None means no cap)
+def get_max_tokens(tenant_name, chat_id, personality):
+    max_tokens = personality.get('max_tokens')
+    overshoot = get_quota_overshoot(tenant_name, chat_id, personality)
+    if overshoot:
+        if max_tokens is None:
+            # Uncapped personalities start at THROTTLED_MAX_TOKENS on the first overshoot
+            max_tokens = THROTTLED_MAX_TOKENS << 1
+        # The floor never raises the cap above the personality's own value
+        max_tokens = min(max_tokens, max(MIN_MAX_TOKENS, max_tokens >> overshoot))
+    return max_tokens
+
+# Get the number of history messages to store, enough for the largest history_limit of the personalities
+def get_history_cap(personalities):
+    return max([DEFAULT_HISTORY_LIMIT] + [personality.get('history_limit', DEFAULT_HISTORY_LIMIT) for personality in personalities.values()])
+
+# Get the chat history trimmed to the current history budget
+def get_history_window(tenant_name, chat_id, personality, history):
+    limit = get_history_limit(tenant_name, chat_id, personality)
+    if limit <= 0:
+        return []
+    if len(history) > limit:
+        if get_quota_overshoot(tenant_name, chat_id, personality):
+            logger.info(f"chat_id {chat_id} is over its daily token quota, sending only the last {limit} messages")
+        return history[-limit:]
+    return history
+
+# Set max_tokens on a memory check payload if the personality sets memory_check_max_tokens
+def apply_memory_check_max_tokens(payload, personality):
+    max_tokens = personality.get('memory_check_max_tokens')
+    if max_tokens is not None:
+        payload["max_tokens"] = max_tokens
+    return payload
+
+# Set max_tokens on a payload if the chat has an output cap
+def apply_max_tokens(payload, tenant_name, chat_id, personality):
+    max_tokens = get_max_tokens(tenant_name, chat_id, personality)
+    if max_tokens is not None:
+        payload["max_tokens"] = max_tokens
+    return payload
+
+# Format a tenant's usage totals for the /usage command, for one chat or all chats
+def format_usage(tenant_name, chat_id=None):
+    rows = {}
+    for (usage_tenant_name, usage_chat_id, personality_name, call_type), (prompt_tokens, completion_tokens, calls) in token_usage.items():
+        if usage_tenant_name != tenant_name or (chat_id is not None and usage_chat_id != chat_id):
+            continue
+        group = (usage_chat_id, personality_name, call_type) if chat_id is not None else usage_chat_id
+        row = rows.setdefault(group, [0, 0, 0])
+        row[0] += prompt_tokens
+        row[1] += completion_tokens
+        row[2] += calls
+
+    if not rows:
+        return 'No token usage recorded.'
+
+    if chat_id is not None:
+        lines = [f"Token usage for chat {chat_id} (today: {get_daily_usage(tenant_name, chat_id)}):"]
+        for (_, personality_name, call_type), (prompt_tokens, completion_tokens, calls) in sorted(rows.items()):
+            lines.append(f"{personality_name} / {call_type}: {calls} calls, {prompt_tokens} prompt + {completion_tokens} completion tokens")
+    else:
+        ranked = sorted(rows.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)
+        lines = [f"Token usage by chat (top {min(len(ranked), USAGE_TOP_CHATS)} of {len(ranked)}):"]
+        for usage_chat_id, (prompt_tokens, completion_tokens, calls) in ranked[:USAGE_TOP_CHATS]:
+            lines.append(f"{usage_chat_id}: {calls} calls, {prompt_tokens} prompt + {completion_tokens} completion tokens (today: {get_daily_usage(tenant_name, usage_chat_id)})")
+        total_prompt_tokens = sum(row[0] for row in rows.values())
+        total_completion_tokens = sum(row[1] for row in rows.values())
+        total_calls = sum(row[2] for row in rows.values())
+        lines.append(f"Total: {total_calls} calls, {total_prompt_tokens} prompt + {total_completion_tokens} completion tokens")
+    return "\n".join(lines)